@@ -1,21 +1,59 @@
-import simplejson
-import eventlet
+import threading
+import orjson
 from flask import Flask, send_from_directory, request
 from flask_socketio import SocketIO
 
-# Suppress eventlet warnings related to monkey patching
-eventlet.monkey_patch()
+# orjson-backed stand-in for the json module used by Socket.IO's packet encoder.
+# orjson always produces compact output, so the keyword arguments the encoder
+# passes (e.g. separators) are accepted and ignored.
+class OrjsonModule:
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
 # Initialize Flask App
 app = Flask(__name__)
 # IMPORTANT: Use a real secret key in production, but this placeholder is fine for now
 app.config['SECRET_KEY'] = 'your_secret_key' 
 # Initialize SocketIO, allowing connections from any domain (crucial for multiplayer)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+# Socket.IO packets are framed with MessagePack (much smaller than JSON for the
+# x/y floats sent on every move); OrjsonModule still handles Engine.IO's own
+# JSON packets such as the handshake. WebSocket support in threading mode comes
+# from the simple-websocket package. Every handler here is short and
+# non-blocking, so async_handlers=False runs each one inline on its client's
+# connection thread: no thread per event, and a client's moves apply in order
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading',
+                    async_handlers=False, serializer='msgpack', json=OrjsonModule)
 
 # Dictionary to hold the real-time position and state of all players
 player_states = {}
 
+# IDs of players whose state changed since the last broadcast tick
+dirty_ids = set()
+# Handlers for different clients run on their own connection threads,
+# concurrently with each other and with broadcast_loop, so every change to
+# dirty_ids (and the swap in broadcast_loop) happens under this lock.
+# broadcast_loop's unlocked emptiness check is only a hint; a missed add is
+# sent next tick.
+dirty_lock = threading.Lock()
+# Held while building and emitting a tick, and while removing a player and
+# announcing it, so a players_tick can never mention a player after their
+# player_disconnected went out. Emits only queue packets, so holding it is cheap.
+broadcast_lock = threading.Lock()
+
+# Seconds between movement broadcasts (50ms = 20 ticks per second)
+BROADCAST_INTERVAL = 0.05
+
+# broadcast_loop is started by the first connection rather than at import time,
+# so importing this module (tooling, test clients, gunicorn --preload) doesn't
+# spawn it, and it always runs in the process that serves the clients
+broadcast_task = None
+broadcast_task_lock = threading.Lock()
+
 # --- Routes ---
 
 # Serves the index.html file for the main game page
@@ -30,56 +68,100 @@ def index():
 @socketio.on('connect')
 def handle_connect():
     """Handles a new client connecting to the server."""
+    global broadcast_task
     player_id = request.sid
     print(f'Client {player_id} connected.')
 
+    with broadcast_task_lock:
+        if broadcast_task is None:
+            broadcast_task = socketio.start_background_task(broadcast_loop)
+
     # 1. Send the new player their unique ID
-    socketio.emit('your_id', player_id, room=player_id)
-    
-    # 2. Send the existing game state to the new player
-    # We use simplejson.dumps() to ensure complex data is transmitted correctly
-    socketio.emit('initial_state', simplejson.dumps(player_states), room=player_id)
-    
-    # 3. Broadcast the new player's connection to everyone else
-    socketio.emit('player_connected', player_id, broadcast=True, include_self=False)
+    socketio.emit('your_id', player_id, to=player_id)
     
-    # Initialize the new player's starting state
-    player_states[player_id] = {'x': 100, 'y': 100, 'dir': 'down'}
+    # Encoding initial_state walks player_states, which another client's
+    # connect or disconnect could resize mid-walk without the lock
+    with broadcast_lock:
+        # 2. Send the existing game state to the new player
+        socketio.emit('initial_state', player_states, to=player_id)
+
+        # 3. Broadcast the new player's connection to everyone else
+        socketio.emit('player_connected', player_id, include_self=False)
+
+        # Initialize the new player's starting state
+        player_states[player_id] = {'x': 100, 'y': 100, 'dir': 'down'}
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handles a client disconnecting from the server."""
     player_id = request.sid
-    if player_id in player_states:
-        del player_states[player_id]
-        print(f'Client {player_id} disconnected.')
-        # Broadcast removal to all remaining clients
-        socketio.emit('player_disconnected', player_id, broadcast=True)
+    with broadcast_lock:
+        with dirty_lock:
+            dirty_ids.discard(player_id)
+        if player_states.pop(player_id, None) is not None:
+            print(f'Client {player_id} disconnected.')
+            # Broadcast removal to all remaining clients
+            socketio.emit('player_disconnected', player_id)
 
 @socketio.on('player_data')
 def handle_player_data(data):
     """Handles frequent position updates from a client."""
     player_id = request.sid
-    
-    try:
-        data_obj = simplejson.loads(data)
-    except Exception as e:
-        print(f"Error parsing JSON data from {player_id}: {e}")
-        return
-
-    # Update the server's internal game state
-    if player_id in player_states:
+
+    # Clients emit the position as an object, which Socket.IO has already
+    # decoded; only legacy clients that stringify it need a second parse
+    if isinstance(data, dict):
+        data_obj = data
+    else:
+        try:
+            data_obj = orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            print(f"Error parsing JSON data from {player_id}: {e}")
+            return
+        if not isinstance(data_obj, dict):
+            print(f"Ignoring malformed player data from {player_id}")
+            return
+
+    # Update the server's internal game state. Look the entry up once: a
+    # disconnect on another thread may remove it at any point
+    state = player_states.get(player_id)
+    if state is not None:
         # Simple safety check to only update expected keys
-        player_states[player_id]['x'] = data_obj.get('x', player_states[player_id]['x'])
-        player_states[player_id]['y'] = data_obj.get('y', player_states[player_id]['y'])
-        player_states[player_id]['dir'] = data_obj.get('dir', player_states[player_id]['dir'])
-        
-    # Broadcast the data to all other players (they use this to update their screen)
-    socketio.emit('player_moved', simplejson.dumps({
-        'id': player_id, 
-        'data': data_obj
-    }), broadcast=True, include_self=False)
+        state['x'] = data_obj.get('x', state['x'])
+        state['y'] = data_obj.get('y', state['y'])
+        state['dir'] = data_obj.get('dir', state['dir'])
+        # Picked up by broadcast_loop on the next tick
+        with dirty_lock:
+            dirty_ids.add(player_id)
+
+# --- Background Tasks ---
+
+def broadcast_loop():
+    """Sends the states of all players that moved since the last tick, once per tick."""
+    global dirty_ids
+    while True:
+        socketio.sleep(BROADCAST_INTERVAL)
+        if not dirty_ids:
+            continue
+        # A failed tick must not end the loop, or every client stops receiving
+        # movement updates until the process restarts
+        try:
+            with broadcast_lock:
+                # Swap in a fresh set before building the payload, so moves
+                # handled while this tick is being sent land in the next one
+                with dirty_lock:
+                    moved, dirty_ids = dirty_ids, set()
+                tick = {}
+                for pid in moved:
+                    # Players that disconnected since moving are skipped
+                    state = player_states.get(pid)
+                    if state is not None:
+                        tick[pid] = state
+                # Clients receive their own entry too and should ignore it
+                socketio.emit('players_tick', tick)
+        except Exception as e:
+            print(f"Error broadcasting movement tick: {e}")
 
 # CRITICAL: We expose the 'app' object here. Gunicorn will look for 'server:app'
-# to start the application using the Start Command: gunicorn --worker-class eventlet -w 1 server:app
+# to start the application using the Start Command: gunicorn -w 1 --threads 100 server:app